@@ -103,6 +103,7 @@ private struct LinearCongruentialGenerator {
 /// Simple tokenizer for BERT-style models (MVP implementation)
 struct SimpleTokenizer {
     let maxLength: Int = 128
+    let sequenceBuckets: [Int]  // Input lengths the loaded model accepts, ascending
     let clsToken: Int32 = 101  // [CLS]
     let sepToken: Int32 = 102  // [SEP]
     let padToken: Int32 = 0    // [PAD]
@@ -119,12 +120,15 @@ struct SimpleTokenizer {
 
         inputIds.append(sepToken)
 
+        // Pad only to the smallest sequence bucket that fits
+        let paddedLength = sequenceBuckets.first { $0 >= inputIds.count } ?? maxLength
+
         // Create attention mask (1 for real tokens, 0 for padding)
         let attentionMask = [Int32](repeating: 1, count: inputIds.count) +
-                           [Int32](repeating: 0, count: maxLength - inputIds.count)
+                           [Int32](repeating: 0, count: paddedLength - inputIds.count)
 
         // Pad input IDs
-        inputIds += [Int32](repeating: padToken, count: maxLength - inputIds.count)
+        inputIds += [Int32](repeating: padToken, count: paddedLength - inputIds.count)
 
         return (inputIds, attentionMask)
     }
@@ -149,6 +153,7 @@ public actor CoreMLEmbeddingModel: Sendable {
         let config = MLModelConfiguration()
         config.computeUnits = .cpuAndNeuralEngine  // Use Neural Engine if available
 
+        let model: MLModel
         if let path = modelPath {
             var url = URL(fileURLWithPath: path)
 
@@ -163,7 +168,7 @@ public actor CoreMLEmbeddingModel: Sendable {
                 }
             }
 
-            self.model = try MLModel(contentsOf: url, configuration: config)
+            model = try MLModel(contentsOf: url, configuration: config)
         } else {
             // Use bundled model (default for iOS app)
             guard let modelURL = Bundle.main.url(forResource: "MiniLM_L6_v2", withExtension: "mlmodelc")
@@ -174,13 +179,29 @@ public actor CoreMLEmbeddingModel: Sendable {
             if modelURL.pathExtension == "mlpackage" {
                 // Compile if needed
                 let compiledURL = try MLModel.compileModel(at: modelURL)
-                self.model = try MLModel(contentsOf: compiledURL, configuration: config)
+                model = try MLModel(contentsOf: compiledURL, configuration: config)
             } else {
-                self.model = try MLModel(contentsOf: modelURL, configuration: config)
+                model = try MLModel(contentsOf: modelURL, configuration: config)
             }
         }
 
-        self.tokenizer = SimpleTokenizer()
+        self.model = model
+        self.tokenizer = SimpleTokenizer(sequenceBuckets: Self.sequenceBuckets(for: model))
+    }
+
+    /// Sequence lengths the model accepts for `input_ids`
+    /// Uses the enumerated shapes of flexible models, or the fixed length (128) otherwise
+    private static func sequenceBuckets(for model: MLModel) -> [Int] {
+        guard let constraint = model.modelDescription.inputDescriptionsByName["input_ids"]?.multiArrayConstraint else {
+            return [128]
+        }
+
+        let enumerated = constraint.shapeConstraint.enumeratedShapes.compactMap { $0.last?.intValue }
+        if !enumerated.isEmpty {
+            return enumerated.sorted()
+        }
+
+        return [constraint.shape.last?.intValue ?? 128]
     }
 
     public func embed(_ text: String) async throws -> [Float] {
@@ -195,10 +216,11 @@ public actor CoreMLEmbeddingModel: Sendable {
             let (inputIds, attentionMask) = tokenizer.encode(text)
 
             // Create MLMultiArray inputs
-            let inputIdsArray = try MLMultiArray(shape: [1, 128], dataType: .int32)
-            let attentionMaskArray = try MLMultiArray(shape: [1, 128], dataType: .int32)
+            let sequenceLength = inputIds.count
+            let inputIdsArray = try MLMultiArray(shape: [1, NSNumber(value: sequenceLength)], dataType: .int32)
+            let attentionMaskArray = try MLMultiArray(shape: [1, NSNumber(value: sequenceLength)], dataType: .int32)
 
-            for i in 0..<128 {
+            for i in 0..<sequenceLength {
                 inputIdsArray[i] = NSNumber(value: inputIds[i])
                 attentionMaskArray[i] = NSNumber(value: attentionMask[i])
             }
@@ -7,17 +7,34 @@ for on-device inference on iOS/macOS.
 """
 
 import coremltools as ct
+import coremltools.optimize.coreml as cto
+import numpy as np
 import torch
+import transformers
 from transformers import AutoTokenizer, AutoModel
 from sentence_transformers import SentenceTransformer
+import hashlib
 import os
 import shutil
+import tempfile
+
+# Sequence lengths the model accepts; callers pad to the smallest bucket that fits.
+# A fixed set of enumerated shapes keeps the model eligible for the Neural Engine,
+# which a RangeDim input (even a bounded one) generally does not.
+SEQUENCE_BUCKETS = (16, 32, 64, 128)
+
+# Post-conversion weight compression: "palettize" (4-bit k-means) or "linear" (int8)
+WEIGHT_COMPRESSION = os.environ.get("WEIGHT_COMPRESSION", "palettize")
 
 def mean_pooling(model_output, attention_mask):
-    """Mean pooling - take attention mask into account for correct averaging."""
+    """Mean pooling - take attention mask into account for correct averaging.
+
+    Dividing by the token count keeps magnitudes bounded, so the L2 norm of the
+    result does not overflow in FP16 for long inputs.
+    """
     token_embeddings = model_output[0]
-    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+    counts = attention_mask.sum(1, keepdim=True).clamp_min(1).float()
+    return torch.einsum('btd,bt->bd', token_embeddings, attention_mask.float()) / counts
 
 class EmbeddingModelWrapper(torch.nn.Module):
     """Wrapper for the embedding model that includes mean pooling."""
@@ -31,68 +48,126 @@ class EmbeddingModelWrapper(torch.nn.Module):
         outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
         embeddings = mean_pooling(outputs, attention_mask)
         # Normalize embeddings
-        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1, eps=1e-12)
         return embeddings
 
-def convert_embedding_model():
-    """Convert all-MiniLM-L6-v2 to Core ML."""
+def palettize_weights(mlmodel, nbits=4):
+    """Compress weights to an n-bit lookup table using k-means palettization."""
+    config = cto.OptimizationConfig(
+        global_config=cto.OpPalettizerConfig(mode="kmeans", nbits=nbits)
+    )
+    return cto.palettize_weights(mlmodel, config)
 
-    print("Loading all-MiniLM-L6-v2 from HuggingFace...")
-    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+def linear_quantize_weights(mlmodel):
+    """Quantize weights to int8 using symmetric per-channel linear quantization."""
+    config = cto.OptimizationConfig(
+        global_config=cto.OpLinearQuantizerConfig(mode="linear_symmetric", dtype=np.int8)
+    )
+    return cto.linear_quantize_weights(mlmodel, config)
 
-    # Load tokenizer and model
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    base_model = AutoModel.from_pretrained(model_name)
+def compress_weights(mlmodel):
+    """Apply the weight compression selected by WEIGHT_COMPRESSION.
 
-    # Wrap the model with pooling
-    model = EmbeddingModelWrapper(base_model)
-    model.eval()
+    The mode is recorded in the model metadata so test_models.py can pick a
+    matching accuracy threshold.
+    """
+    if WEIGHT_COMPRESSION == "palettize":
+        print("Palettizing weights (4-bit k-means)...")
+        mlmodel = palettize_weights(mlmodel)
+    elif WEIGHT_COMPRESSION == "linear":
+        print("Quantizing weights (int8 linear symmetric)...")
+        mlmodel = linear_quantize_weights(mlmodel)
+    else:
+        raise ValueError(f"Unknown WEIGHT_COMPRESSION: {WEIGHT_COMPRESSION}")
+    mlmodel.user_defined_metadata["weight_compression"] = WEIGHT_COMPRESSION
+    return mlmodel
 
-    print("Creating example inputs...")
-    # Create example inputs (max sequence length = 128)
-    max_seq_length = 128
-    example_text = "This is an example sentence for embedding."
+def conversion_cache_key(model):
+    """Hex digest of weights, script, and library versions, used as the conversion cache key.
 
-    # Tokenize
-    encoded = tokenizer(
-        example_text,
-        padding='max_length',
-        truncation=True,
-        max_length=max_seq_length,
-        return_tensors='pt'
-    )
+    Hashing the script source and the torch/coremltools/transformers versions
+    invalidates cached artifacts when the wrapper, conversion settings, or
+    toolchain change.
+    """
+    digest = hashlib.sha256()
+    for version in (torch.__version__, ct.__version__, transformers.__version__):
+        digest.update(version.encode())
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    with open(__file__, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
 
-    example_input_ids = encoded['input_ids']
-    example_attention_mask = encoded['attention_mask']
+def prune_cache(cache_dir, cache_key):
+    """Remove everything except cache_key's traced model and converted packages.
 
-    print(f"Input shape: {example_input_ids.shape}")
+    Only the exact <key>.pt and <key>-<mode>.mlpackage names are kept, so
+    leftovers from interrupted saves (<key>.pt.tmp, temporary directories) are
+    removed too.
+    """
+    for entry in os.listdir(cache_dir):
+        is_traced_model = entry == f"{cache_key}.pt"
+        is_mlpackage = entry.startswith(f"{cache_key}-") and entry.endswith(".mlpackage")
+        if is_traced_model or is_mlpackage:
+            continue
+        path = os.path.join(cache_dir, entry)
+        print(f"Removing stale cache entry {path}...")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
-    # Trace the model
-    print("Tracing PyTorch model...")
-    with torch.no_grad():
-        traced_model = torch.jit.trace(
-            model,
-            (example_input_ids, example_attention_mask)
-        )
+def trace_model(model, example_input_ids, example_attention_mask, traced_path):
+    """Trace the model, reusing a previously traced module from traced_path if present."""
+    if os.path.exists(traced_path):
+        print(f"Loading cached traced model from {traced_path}...")
+        traced_model = torch.jit.load(traced_path)
+    else:
+        print("Tracing PyTorch model...")
+        with torch.no_grad():
+            traced_model = torch.jit.trace(
+                model,
+                (example_input_ids, example_attention_mask)
+            )
+            # Freeze to inline parameters and fold constants before conversion
+            traced_model = torch.jit.freeze(traced_model.eval())
+        # Save under a temporary name first so an interrupted save is never a cache hit
+        temp_path = f"{traced_path}.tmp"
+        torch.jit.save(traced_model, temp_path)
+        os.replace(temp_path, traced_path)
 
+    with torch.no_grad():
         # Verify traced model works
         example_output = traced_model(example_input_ids, example_attention_mask)
         print(f"Output shape: {example_output.shape}")  # Should be [1, 384]
         print(f"Output norm: {torch.norm(example_output, dim=1)}")  # Should be ~1.0
 
+    return traced_model
+
+def build_mlmodel(traced_model, example_input_ids, example_attention_mask):
+    """Convert the traced model to Core ML, compress its weights, and set metadata."""
     print("Converting to Core ML...")
+    # Accept each sequence bucket, so short inputs need not be padded to the traced length
+    max_seq_length = example_input_ids.shape[1]
+    # One shared instance, so both inputs get the same sequence-length symbol
+    seq_shape = ct.EnumeratedShapes(
+        shapes=[(1, n) for n in SEQUENCE_BUCKETS],
+        default=(1, max_seq_length)
+    )
+
     # Convert to Core ML
     mlmodel = ct.convert(
         traced_model,
         inputs=[
             ct.TensorType(
                 name="input_ids",
-                shape=example_input_ids.shape,
+                shape=seq_shape,
                 dtype=int
             ),
             ct.TensorType(
                 name="attention_mask",
-                shape=example_attention_mask.shape,
+                shape=seq_shape,
                 dtype=int
             )
         ],
@@ -102,9 +177,14 @@ def convert_embedding_model():
                 dtype=float
             )
         ],
+        convert_to="mlprogram",
+        pass_pipeline=ct.PassPipeline.DEFAULT,
         minimum_deployment_target=ct.target.iOS16,
     )
 
+    # Compress weights (smaller than FP16, less memory traffic at inference)
+    mlmodel = compress_weights(mlmodel)
+
     # Set model metadata
     mlmodel.short_description = "all-MiniLM-L6-v2 sentence embedding model"
     mlmodel.author = "sentence-transformers"
@@ -118,9 +198,67 @@ def convert_embedding_model():
     # Add output description
     mlmodel.output_description["embeddings"] = "384-dimensional normalized embedding vector"
 
-    # Create output directory
+    return mlmodel
+
+def convert_embedding_model():
+    """Convert all-MiniLM-L6-v2 to Core ML."""
+
+    print("Loading all-MiniLM-L6-v2 from HuggingFace...")
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+
+    # Load tokenizer and model
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    base_model = AutoModel.from_pretrained(model_name)
+
+    # Wrap the model with pooling
+    model = EmbeddingModelWrapper(base_model)
+    model.eval()
+
+    # Create output and cache directories
     output_dir = "/workspace/output"
-    os.makedirs(output_dir, exist_ok=True)
+    cache_dir = os.path.join(output_dir, ".cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Cache traced and converted models so unchanged models skip tracing and conversion
+    model_hash = conversion_cache_key(model)
+    prune_cache(cache_dir, model_hash)
+    traced_path = os.path.join(cache_dir, f"{model_hash}.pt")
+    cached_mlpackage_path = os.path.join(cache_dir, f"{model_hash}-{WEIGHT_COMPRESSION}.mlpackage")
+
+    print("Creating example inputs...")
+    # Create example inputs (max sequence length = 128)
+    max_seq_length = 128
+    example_text = "This is an example sentence for embedding."
+
+    # Tokenize
+    encoded = tokenizer(
+        example_text,
+        padding='max_length',
+        truncation=True,
+        max_length=max_seq_length,
+        return_tensors='pt'
+    )
+
+    example_input_ids = encoded['input_ids']
+    example_attention_mask = encoded['attention_mask']
+
+    print(f"Input shape: {example_input_ids.shape}")
+
+    if os.path.exists(cached_mlpackage_path):
+        print(f"Reusing cached Core ML model from {cached_mlpackage_path}...")
+    else:
+        traced_model = trace_model(model, example_input_ids, example_attention_mask, traced_path)
+        mlmodel = build_mlmodel(traced_model, example_input_ids, example_attention_mask)
+
+        # Save into a temporary directory and move it into place, so an interrupted
+        # save never leaves a partial package under the cache name
+        temp_dir = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            temp_mlpackage_path = os.path.join(temp_dir, "MiniLM_L6_v2.mlpackage")
+            mlmodel.save(temp_mlpackage_path)
+            os.replace(temp_mlpackage_path, cached_mlpackage_path)
+        finally:
+            shutil.rmtree(temp_dir)
 
     # Save the model
     output_path = os.path.join(output_dir, "MiniLM_L6_v2.mlpackage")
@@ -130,17 +268,18 @@ def convert_embedding_model():
         shutil.rmtree(output_path)
 
     print(f"Saving Core ML model to {output_path}...")
-    mlmodel.save(output_path)
+    shutil.copytree(cached_mlpackage_path, output_path)
 
     print("✅ Conversion complete!")
     print(f"Model saved to: {output_path}")
-    print(f"Input shape: [1, {max_seq_length}] (input_ids and attention_mask)")
+    print(f"Input shape: [1, N], N in {SEQUENCE_BUCKETS} (input_ids and attention_mask)")
     print(f"Output shape: [1, 384] (normalized embeddings)")
 
     # Save tokenizer vocab for reference
     vocab_path = os.path.join(output_dir, "vocab.txt")
-    tokenizer.save_vocabulary(output_dir)
-    print(f"Tokenizer vocabulary saved to: {output_dir}")
+    if not os.path.exists(vocab_path):
+        tokenizer.save_vocabulary(output_dir)
+        print(f"Tokenizer vocabulary saved to: {output_dir}")
 
     return output_path
 
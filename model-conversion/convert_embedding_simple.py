@@ -5,12 +5,22 @@ Uses a more compatible approach with latest coremltools.
 """
 
 import coremltools as ct
+import coremltools.optimize.coreml as cto
+import numpy as np
 import torch
 import torch.nn as nn
 from sentence_transformers import SentenceTransformer
 import os
 import shutil
 
+# Sequence lengths the model accepts; callers pad to the smallest bucket that fits.
+# A fixed set of enumerated shapes keeps the model eligible for the Neural Engine,
+# which a RangeDim input (even a bounded one) generally does not.
+SEQUENCE_BUCKETS = (16, 32, 64, 128)
+
+# Post-conversion weight compression: "palettize" (4-bit k-means) or "linear" (int8)
+WEIGHT_COMPRESSION = os.environ.get("WEIGHT_COMPRESSION", "palettize")
+
 class SimplifiedEmbeddingModel(nn.Module):
     """Simplified wrapper that avoids complex operations."""
 
@@ -24,18 +34,47 @@ class SimplifiedEmbeddingModel(nn.Module):
         outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
         token_embeddings = outputs[0]
 
-        # Mean pooling
-        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-        sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
-        sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+        # Mean pooling (dividing by the token count keeps the FP16 norm from overflowing)
+        sum_embeddings = torch.einsum('btd,bt->bd', token_embeddings, attention_mask.float())
+        sum_mask = attention_mask.sum(1, keepdim=True).clamp_min(1).float()
         embeddings = sum_embeddings / sum_mask
 
         # L2 normalization
-        norm = torch.norm(embeddings, p=2, dim=1, keepdim=True)
-        embeddings = embeddings / norm
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1, eps=1e-12)
 
         return embeddings
 
+def palettize_weights(mlmodel, nbits=4):
+    """Compress weights to an n-bit lookup table using k-means palettization."""
+    config = cto.OptimizationConfig(
+        global_config=cto.OpPalettizerConfig(mode="kmeans", nbits=nbits)
+    )
+    return cto.palettize_weights(mlmodel, config)
+
+def linear_quantize_weights(mlmodel):
+    """Quantize weights to int8 using symmetric per-channel linear quantization."""
+    config = cto.OptimizationConfig(
+        global_config=cto.OpLinearQuantizerConfig(mode="linear_symmetric", dtype=np.int8)
+    )
+    return cto.linear_quantize_weights(mlmodel, config)
+
+def compress_weights(mlmodel):
+    """Apply the weight compression selected by WEIGHT_COMPRESSION.
+
+    The mode is recorded in the model metadata so test_models.py can pick a
+    matching accuracy threshold.
+    """
+    if WEIGHT_COMPRESSION == "palettize":
+        print("Palettizing weights (4-bit k-means)...")
+        mlmodel = palettize_weights(mlmodel)
+    elif WEIGHT_COMPRESSION == "linear":
+        print("Quantizing weights (int8 linear symmetric)...")
+        mlmodel = linear_quantize_weights(mlmodel)
+    else:
+        raise ValueError(f"Unknown WEIGHT_COMPRESSION: {WEIGHT_COMPRESSION}")
+    mlmodel.user_defined_metadata["weight_compression"] = WEIGHT_COMPRESSION
+    return mlmodel
+
 def convert_embedding_model():
     """Convert all-MiniLM-L6-v2 to Core ML using simplified approach."""
 
@@ -50,15 +89,23 @@ def convert_embedding_model():
     print("Creating example inputs...")
     # Batch size 1, sequence length 128
     max_seq_length = 128
-    example_input_ids = torch.randint(0, 30522, (1, max_seq_length), dtype=torch.int32, device='cpu')
-    example_attention_mask = torch.ones(1, max_seq_length, dtype=torch.int32, device='cpu')
+    # int64 like tokenizer output, so the trace has no extra casts
+    example_input_ids = torch.randint(0, 30522, (1, max_seq_length), dtype=torch.long, device='cpu')
+    example_attention_mask = torch.ones(1, max_seq_length, dtype=torch.long, device='cpu')
 
     print(f"Input shapes: input_ids={example_input_ids.shape}, attention_mask={example_attention_mask.shape}")
 
+    # Accept each sequence bucket, so short inputs need not be padded to max_seq_length
+    # One shared instance, so both inputs get the same sequence-length symbol
+    seq_shape = ct.EnumeratedShapes(
+        shapes=[(1, n) for n in SEQUENCE_BUCKETS],
+        default=(1, max_seq_length)
+    )
+
     # Test the model
     print("Testing model...")
     with torch.no_grad():
-        example_output = model(example_input_ids.long(), example_attention_mask.long())
+        example_output = model(example_input_ids, example_attention_mask)
         print(f"Output shape: {example_output.shape}")
         print(f"Output norm: {torch.norm(example_output, dim=1)}")
 
@@ -66,9 +113,11 @@ def convert_embedding_model():
     with torch.no_grad():
         traced_model = torch.jit.trace(
             model,
-            (example_input_ids.long(), example_attention_mask.long()),
+            (example_input_ids, example_attention_mask),
             strict=False
         )
+        # Freeze to inline parameters and fold constants before conversion
+        traced_model = torch.jit.freeze(traced_model.eval())
 
     print("Converting to Core ML (this may take a few minutes)...")
     try:
@@ -77,12 +126,12 @@ def convert_embedding_model():
             inputs=[
                 ct.TensorType(
                     name="input_ids",
-                    shape=(1, max_seq_length),
+                    shape=seq_shape,
                     dtype=int
                 ),
                 ct.TensorType(
                     name="attention_mask",
-                    shape=(1, max_seq_length),
+                    shape=seq_shape,
                     dtype=int
                 )
             ],
@@ -91,10 +140,15 @@ def convert_embedding_model():
                     name="embeddings"
                 )
             ],
+            convert_to="mlprogram",
+            pass_pipeline=ct.PassPipeline.DEFAULT,
             minimum_deployment_target=ct.target.iOS16,
-            compute_precision=ct.precision.FLOAT32
+            compute_precision=ct.precision.FLOAT16
         )
 
+        # Compress weights (smaller than FP16, less memory traffic at inference)
+        mlmodel = compress_weights(mlmodel)
+
         # Set metadata
         mlmodel.short_description = "all-MiniLM-L6-v2 sentence embedding model"
         mlmodel.author = "sentence-transformers"
@@ -118,7 +172,7 @@ def convert_embedding_model():
 
         print("✅ Conversion complete!")
         print(f"Model saved to: {output_path}")
-        print(f"Input shape: [1, {max_seq_length}] (input_ids and attention_mask)")
+        print(f"Input shape: [1, N], N in {SEQUENCE_BUCKETS} (input_ids and attention_mask)")
         print(f"Output shape: [1, 384] (normalized embeddings)")
 
         return output_path
@@ -131,12 +185,14 @@ def convert_embedding_model():
         mlmodel = ct.convert(
             traced_model,
             inputs=[
-                ct.TensorType(name="input_ids", shape=(1, max_seq_length)),
-                ct.TensorType(name="attention_mask", shape=(1, max_seq_length))
+                ct.TensorType(name="input_ids", shape=seq_shape),
+                ct.TensorType(name="attention_mask", shape=seq_shape)
             ],
             convert_to="mlprogram",
+            pass_pipeline=ct.PassPipeline.DEFAULT,
             minimum_deployment_target=ct.target.iOS16
         )
+        mlmodel = compress_weights(mlmodel)
 
         output_dir = "Models"
         os.makedirs(output_dir, exist_ok=True)